@@ -1,13 +1,47 @@
 # ==============================================================================
 # --- BIBLIOTECAS (IMPORTS) ---
 # ==============================================================================
+import hashlib
+import importlib.util
+import json
 import os
-import base64  # Essencial para decodificar a imagem
-from flask import Flask, request, jsonify  # Componentes da API Flask
+import queue
+import textwrap
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as TempoEsgotadoFuturo
+from operator import itemgetter
+import binascii  # Essencial para decodificar a imagem (base64)
+from flask import Flask, Response, request, jsonify, stream_with_context  # Componentes da API Flask
+from requests import Session
+from requests.adapters import HTTPAdapter
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.core.rest import HttpRequest
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeResult
-from openai import AzureOpenAI
+import httpx
+from openai import AzureOpenAI, DefaultHttpxClient
+
+# pybase64 (libbase64 com SIMD) é opcional: decodifica payloads grandes várias
+# vezes mais rápido. Sem ele, usamos o decodificador da biblioteca padrão.
+try:
+    import pybase64
+    def decodificar_base64(conteudo):
+        return pybase64.b64decode(conteudo, validate=False)
+except ImportError:
+    decodificar_base64 = binascii.a2b_base64
+
+# orjson (parser em Rust/SIMD) também é opcional: faz o parse do corpo com a string
+# base64 de vários MB bem mais rápido que o json da biblioteca padrão.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ==============================================================================
 # --- 1. CONFIGURAÇÃO E CREDENCIAIS (A PARTIR DE VARIÁVEIS DE AMBIENTE) ---
@@ -40,26 +74,215 @@ if not all(required_vars):
     # Este erro agora será mostrado se você tentar rodar a API sem definir as variáveis.
     raise ValueError(f"ERRO FATAL: As seguintes variáveis de ambiente obrigatórias não foram definidas: {', '.join(missing_vars)}")
 
+# --- Clientes dos serviços de IA (criados uma única vez e reutilizados) ---
+# Criar os clientes a cada requisição refaz TLS, credenciais e transporte HTTP.
+# Os clientes síncronos dos dois SDKs são seguros para uso entre threads, então
+# todas as requisições compartilham o mesmo pool de conexões (keep-alive).
+POOL_CONEXOES = 32
+
+# --- Concorrência e taxa de chamadas ---
+# Limita quantas análises OCR ficam em andamento ao mesmo tempo por processo e,
+# com um balde de fichas (token bucket), quantas são iniciadas por segundo, para
+# não estourar a cota de transações por segundo do Document Intelligence. O limite
+# vale por processo: com vários workers do Gunicorn, divida a cota entre eles.
+# As retentativas para 429/cotas e erros 5xx ficam com as políticas padrão dos
+# SDKs (azure-core: até 10 tentativas com backoff exponencial; openai: 2).
+MAX_OCR_SIMULTANEOS = 16
+MAX_OCR_POR_SEGUNDO = float(os.environ.get("OCR_MAX_RPS") or 10)
+_semaforo_ocr = threading.BoundedSemaphore(MAX_OCR_SIMULTANEOS)
+_fichas_ocr = MAX_OCR_POR_SEGUNDO
+_ultima_reposicao_ocr = time.monotonic()
+_trava_taxa_ocr = threading.Lock()
+
+
+def _aguardar_vez_ocr():
+    global _fichas_ocr, _ultima_reposicao_ocr
+    while True:
+        with _trava_taxa_ocr:
+            agora = time.monotonic()
+            _fichas_ocr = min(MAX_OCR_POR_SEGUNDO, _fichas_ocr + (agora - _ultima_reposicao_ocr) * MAX_OCR_POR_SEGUNDO)
+            _ultima_reposicao_ocr = agora
+            if _fichas_ocr >= 1:
+                _fichas_ocr -= 1
+                return
+            espera = (1 - _fichas_ocr) / MAX_OCR_POR_SEGUNDO
+        time.sleep(espera)
+
+
+_sessao_doc_intel = Session()
+_sessao_doc_intel.mount("https://", HTTPAdapter(pool_connections=POOL_CONEXOES, pool_maxsize=POOL_CONEXOES))
+
+DOC_INTEL_CLIENT = DocumentIntelligenceClient(
+    endpoint=doc_intel_endpoint,
+    credential=AzureKeyCredential(doc_intel_key),
+    transport=RequestsTransport(session=_sessao_doc_intel, session_owner=False)
+)
+# A Azure OpenAI aceita HTTP/2: com o pacote h2 instalado, as chamadas simultâneas
+# são multiplexadas em poucas conexões em vez de abrir uma conexão por chamada.
+HTTP2_DISPONIVEL = importlib.util.find_spec("h2") is not None
+OPENAI_CLIENT = AzureOpenAI(
+    api_version=openai_api_version,
+    azure_endpoint=openai_endpoint,
+    api_key=openai_key,
+    http_client=DefaultHttpxClient(
+        http2=HTTP2_DISPONIVEL,
+        limits=httpx.Limits(max_connections=2 * POOL_CONEXOES, max_keepalive_connections=POOL_CONEXOES)
+    )
+)
+
+
+# --- Aquecimento das conexões ---
+# Uma chamada leve a cada serviço já resolve DNS e abre as conexões TLS do pool;
+# assim a primeira requisição real não paga esse custo. Não roda na importação:
+# é disparado por iniciar_aquecimento() no hook post_worker_init do Gunicorn
+# (gunicorn.conf.py) ou ao iniciar o servidor de desenvolvimento. Falhas aqui
+# são só registradas.
+def aquecer_clientes():
+    try:
+        DOC_INTEL_CLIENT.send_request(HttpRequest("GET", doc_intel_endpoint))
+        print("✅ Conexão com o Document Intelligence aquecida.")
+    except Exception as e:
+        print(f"AVISO: falha ao aquecer a conexão com o Document Intelligence: {e}")
+    try:
+        OPENAI_CLIENT.models.list()
+        print("✅ Conexão com a Azure OpenAI aquecida.")
+    except Exception as e:
+        print(f"AVISO: falha ao aquecer a conexão com a Azure OpenAI: {e}")
+
+
+def iniciar_aquecimento():
+    threading.Thread(target=aquecer_clientes, name="aquecimento", daemon=True).start()
+
+# --- Cache de resultados do OCR (opcional) ---
+# Documentos idênticos (retentativas, digitalizações duplicadas) reaproveitam o
+# resultado do OCR, indexado pelo hash do conteúdo. Desativado por padrão, já que
+# documentos médicos podem exigir que nada seja mantido em memória entre chamadas.
+OCR_CACHE_ATIVO = os.environ.get("OCR_CACHE_ENABLED", "").lower() in ("1", "true", "sim")
+OCR_CACHE_TTL = int(os.environ.get("OCR_CACHE_TTL_SECONDS") or 24 * 60 * 60)
+MAX_CACHE_OCR = 512
+_cache_ocr = OrderedDict()
+_trava_cache_ocr = threading.Lock()
+
 # ==============================================================================
 # --- 2. INICIALIZAÇÃO DA API FLASK ---
 # ==============================================================================
 app = Flask(__name__)
 
+# --- Limites de tamanho ---
+# Payloads acima do limite são recusados (413) antes de qualquer parse ou
+# decodificação, evitando que um corpo gigante esgote a memória do worker.
+MAX_PAYLOAD_BYTES = int(os.environ.get("MAX_PAYLOAD_MB") or 20) * 1024 * 1024
+MAX_DOCUMENTO_BYTES = int(os.environ.get("MAX_DOCUMENT_MB") or 15) * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_PAYLOAD_BYTES
+
 # ==============================================================================
 # --- 3. LÓGICA DE NEGÓCIO (FUNÇÕES DE IA) ---
 # ==============================================================================
 # As funções de IA agora recebem os bytes da imagem diretamente.
 
+def _chave_documento(image_bytes, content_type):
+    return f"{content_type}:{hashlib.blake2b(image_bytes, digest_size=32).hexdigest()}"
+
+
+def _exames_em_cache(chave):
+    with _trava_cache_ocr:
+        entrada = _cache_ocr.get(chave)
+        if entrada is None:
+            return None
+        expira_em, exames = entrada
+        if expira_em <= time.monotonic():
+            del _cache_ocr[chave]
+            return None
+        _cache_ocr.move_to_end(chave)
+        return list(exames)
+
+
+def _guardar_exames(chave, exames):
+    with _trava_cache_ocr:
+        _cache_ocr[chave] = (time.monotonic() + OCR_CACHE_TTL, tuple(exames))
+        _cache_ocr.move_to_end(chave)
+        while len(_cache_ocr) > MAX_CACHE_OCR:
+            _cache_ocr.popitem(last=False)
+
+
+def _exames_selecionados_na_pagina(page):
+    """
+    Associa cada marcação selecionada da página à linha de texto mais próxima e
+    devolve os textos na ordem de leitura (coluna esquerda, depois direita).
+    """
+    itens_selecionados = []
+    ponto_medio_x = page.width / 2
+    if page.selection_marks and page.lines:
+        # Linhas e marcações selecionadas são ordenadas por Y uma única vez por página.
+        # Como as marcações são percorridas de cima para baixo, a faixa de linhas com
+        # |dy| < 20 só avança: cada marcação examina apenas as linhas da sua faixa.
+        linhas_por_y = sorted((line.polygon[1], line.polygon[0], indice) for indice, line in enumerate(page.lines))
+        ys = [linha_y for linha_y, _, _ in linhas_por_y]
+        marcas_por_y = sorted(
+            (mark.polygon[1], mark.polygon[0], ordem)
+            for ordem, mark in enumerate(page.selection_marks) if mark.state == 'selected'
+        )
+        associacoes = []
+        inicio = fim = 0
+        for mark_y, mark_x, ordem in marcas_por_y:
+            while inicio < len(ys) and ys[inicio] <= mark_y - 20:
+                inicio += 1
+            while fim < len(ys) and ys[fim] < mark_y + 20:
+                fim += 1
+            menor_distancia, indice_associado = float('inf'), None
+            for linha_y, linha_x, indice in linhas_por_y[inicio:fim]:
+                dist_y = mark_y - linha_y if mark_y >= linha_y else linha_y - mark_y
+                dist_x = mark_x - linha_x if mark_x >= linha_x else linha_x - mark_x
+                dist_total = dist_y + dist_x / 10
+                # Em caso de empate, vence a linha que aparece primeiro na página.
+                if dist_total < menor_distancia or (dist_total == menor_distancia and indice < indice_associado):
+                    menor_distancia, indice_associado = dist_total, indice
+            if indice_associado is not None:
+                associacoes.append((ordem, indice_associado))
+
+        # Os itens são montados na ordem original das marcações.
+        associacoes.sort()
+        for _, indice_associado in associacoes:
+            linha_associada = page.lines[indice_associado]
+            if linha_associada.content:
+                itens_selecionados.append({
+                    "texto": linha_associada.content,
+                    "pos_y": linha_associada.polygon[1],
+                    "pos_x": linha_associada.polygon[0],
+                    "coluna": 0 if linha_associada.polygon[0] < ponto_medio_x else 1
+                })
+
+    # Uma única ordenação pela chave (coluna, Y): primeiro a coluna esquerda de
+    # cima para baixo, depois a direita. A chave é extraída em C por itemgetter.
+    itens_selecionados.sort(key=itemgetter('coluna', 'pos_y'))
+    return [item['texto'] for item in itens_selecionados]
+
+
 def extrair_exames_do_documento(image_bytes, content_type):
     """
-    Função do OCR: Analisa os bytes de uma imagem e extrai uma lista ordenada
-    de todos os itens que foram selecionados.
+    Função do OCR: Analisa os bytes de uma imagem (ou PDF com várias páginas) e
+    extrai uma lista ordenada de todos os itens que foram selecionados. Com OCR_CACHE_ENABLED, documentos
+    já analisados são respondidos pelo cache.
     """
     print("--- ETAPA 1: INICIANDO OCR ---")
+    if OCR_CACHE_ATIVO:
+        chave = _chave_documento(image_bytes, content_type)
+        exames_em_cache = _exames_em_cache(chave)
+        if exames_em_cache is not None:
+            print(f"✅ OCR respondido pelo cache. {len(exames_em_cache)} exames selecionados encontrados.")
+            return exames_em_cache
+
     try:
-        client = DocumentIntelligenceClient(endpoint=doc_intel_endpoint, credential=AzureKeyCredential(doc_intel_key))
-        poller = client.begin_analyze_document("prebuilt-layout", body=image_bytes, content_type=content_type)
-        result: AnalyzeResult = poller.result()
+        _aguardar_vez_ocr()
+        with _semaforo_ocr:
+            poller = DOC_INTEL_CLIENT.begin_analyze_document("prebuilt-layout", body=image_bytes, content_type=content_type)
+            result: AnalyzeResult = poller.result()
+    except HttpResponseError as e:
+        if e.status_code == 429:
+            print(f"❌ FALHA NA ANÁLISE OCR: limite de requisições/cota excedido mesmo após as retentativas do SDK: {e}")
+        else:
+            print(f"❌ FALHA NA ANÁLISE OCR: {e}")
+        raise  # Lança a exceção para ser tratada pela API
     except Exception as e:
         print(f"❌ FALHA NA ANÁLISE OCR: {e}")
         raise  # Lança a exceção para ser tratada pela API
@@ -68,45 +291,26 @@ def extrair_exames_do_documento(image_bytes, content_type):
         print("AVISO: OCR processado, mas nenhuma página foi encontrada.")
         return []
 
-    page = result.pages[0]
-    itens_selecionados = []
-    if page.selection_marks and page.lines:
-        for mark in page.selection_marks:
-            if mark.state == 'selected':
-                menor_distancia, texto_associado, linha_associada = float('inf'), None, None
-                for line in page.lines:
-                    dist_y = abs(mark.polygon[1] - line.polygon[1])
-                    if dist_y < 20:
-                        dist_x = abs(mark.polygon[0] - line.polygon[0])
-                        dist_total = dist_y + (dist_x / 10)
-                        if dist_total < menor_distancia:
-                            menor_distancia, texto_associado, linha_associada = dist_total, line.content, line
-                if texto_associado and linha_associada:
-                    itens_selecionados.append({
-                        "texto": texto_associado,
-                        "pos_y": linha_associada.polygon[1],
-                        "pos_x": linha_associada.polygon[0]
-                    })
-
-    ponto_medio_x = page.width / 2
-    coluna_esquerda = sorted([item for item in itens_selecionados if item['pos_x'] < ponto_medio_x], key=lambda x: x['pos_y'])
-    coluna_direita = sorted([item for item in itens_selecionados if item['pos_x'] >= ponto_medio_x], key=lambda x: x['pos_y'])
-    exames_ordenados = [item['texto'] for item in coluna_esquerda + coluna_direita]
+    # Cada página é processada em sequência e os exames seguem a ordem das páginas.
+    # (É trabalho de CPU em Python puro: threads não o paralelizam por causa da GIL.)
+    exames_ordenados = [
+        texto for page in result.pages for texto in _exames_selecionados_na_pagina(page)
+    ]
     
+    if OCR_CACHE_ATIVO:
+        _guardar_exames(chave, exames_ordenados)
     print(f"✅ OCR concluído. {len(exames_ordenados)} exames selecionados encontrados.")
     return exames_ordenados
 
 
-def obter_mnemonicos_com_nlp(lista_de_exames):
-    """
-    Função do NLP: Recebe uma lista de exames e usa a IA para encontrar
-    os mnemônicos correspondentes para cada um.
-    """
-    print("--- ETAPA 2: INICIANDO NLP PARA OBTER MNEMÔNICOS ---")
-    system_prompt = """
+# --- Prompt de sistema (constante) ---
+# Fica fixo no nível do módulo e é sempre enviado como messages[0], byte a byte
+# idêntico entre requisições, para que o cache de prefixo de prompt da Azure
+# OpenAI seja aproveitado.
+SYSTEM_PROMPT = textwrap.dedent("""
     Você é um assistente especialista em mnemônicos para exames médicos. Sua função é, para cada exame em uma lista que você receber, fornecer o mnemônico correspondente.
     Se um exame não estiver na sua base de conhecimento, retorne "Mnemônico não encontrado".
-    Apresente o resultado no formato: "Nome do Exame: [Mnemônico]".
+    Responda no formato JSON definido, com exatamente um item em "results" por exame e na mesma ordem da lista recebida: em "exam", o nome do exame exatamente como recebido; em "mnemonic", apenas o mnemônico (por exemplo, "L.A.B.").
 
     Sua base de conhecimento é:
     - Exames Laboratoriais: "L.A.B." (Lembre-se de que "L.A.B." se refere a "Laboratórios Analisam Biomas")
@@ -114,28 +318,370 @@ def obter_mnemonicos_com_nlp(lista_de_exames):
     - Ecografica: "ECO" (Exame de Controle de Órgãos)
     - Tomografica: "TOMO" (Tomografia para Observação de Morfologia Óssea)
     - Cintilografia: "CINTI" (Cintilografia para Identificação de Novas Tomografias Internas)
+""").strip()
+
+
+# --- Base de mnemônicos local ---
+# A mesma base do prompt, consultada localmente: exames conhecidos são respondidos
+# sem chamar a IA. As chaves estão normalizadas (sem acentos, minúsculas); só os
+# exames fora da base seguem para o cache/LLM.
+MNEMONICOS_CONHECIDOS = {
+    "exames laboratoriais": "L.A.B.",
+    "exames anatomopatologicos": "A.P.P.",
+    "ecografica": "ECO",
+    "tomografica": "TOMO",
+    "cintilografia": "CINTI",
+}
+
+
+def _normalizar_nome_exame(exame):
+    sem_acentos = "".join(c for c in unicodedata.normalize("NFKD", exame) if not unicodedata.combining(c))
+    return " ".join(sem_acentos.split()).casefold()
+
+
+def _mnemonico_local(exame):
+    mnemonico = MNEMONICOS_CONHECIDOS.get(_normalizar_nome_exame(exame))
+    return f"{exame}: {mnemonico}" if mnemonico is not None else None
+
+
+# Saída estruturada (JSON Schema estrito): a resposta é um objeto compacto exame ->
+# mnemônico, com parse determinístico e menos tokens de saída que texto livre.
+# Cada item repete o nome do exame com chaves e aspas (por exemplo,
+# {"exam":"Ultrassonografia de abdome total","mnemonic":"Mnemônico não encontrado"}),
+# então o limite de saída é dimensionado para ~40 tokens por exame.
+_decodificador_json = json.JSONDecoder()
+TOKENS_BASE_NLP = 100
+TOKENS_POR_EXAME_NLP = 40
+
+# O uso de tokens (inclusive os vindos do cache de prefixo do prompt) só é
+# enviado no fluxo com stream_options={"include_usage": True}, que a Azure OpenAI
+# aceita a partir da versão 2024-09-01-preview; versões anteriores o rejeitam.
+# As versões são datas ISO, então a comparação como texto basta.
+USO_NO_FLUXO_DISPONIVEL = openai_api_version[:10] >= "2024-09-01"
+FORMATO_RESPOSTA_NLP = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "mnemonicos",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "exam": {"type": "string"},
+                            "mnemonic": {"type": "string"}
+                        },
+                        "required": ["exam", "mnemonic"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+}
+
+
+# --- Cache de mnemônicos por exame ---
+# Os mesmos exames se repetem entre pacientes; guardamos o mnemônico de cada exame
+# (LRU em memória, por processo) para só enviar à IA os exames ainda não vistos.
+# A chave é o nome normalizado, então só o mnemônico é guardado: a linha
+# "Exame: Mnemônico" é sempre montada com o nome exatamente como o chamador o enviou.
+MAX_CACHE_MNEMONICOS = 4096
+_cache_mnemonicos = OrderedDict()
+_trava_cache_mnemonicos = threading.Lock()
+
+
+def _chave_exame(exame):
+    return " ".join(exame.split()).casefold()
+
+
+def _mnemonico_em_cache(exame):
+    with _trava_cache_mnemonicos:
+        mnemonico = _cache_mnemonicos.get(_chave_exame(exame))
+        if mnemonico is None:
+            return None
+        _cache_mnemonicos.move_to_end(_chave_exame(exame))
+    return f"{exame}: {mnemonico}"
+
+
+def _guardar_mnemonico(exame, mnemonico):
+    with _trava_cache_mnemonicos:
+        _cache_mnemonicos[_chave_exame(exame)] = mnemonico
+        _cache_mnemonicos.move_to_end(_chave_exame(exame))
+        while len(_cache_mnemonicos) > MAX_CACHE_MNEMONICOS:
+            _cache_mnemonicos.popitem(last=False)
+
+
+def _itens_completos(texto, posicao):
+    """
+    Lê, a partir de `posicao`, os itens de "results" que já chegaram completos no
+    JSON parcial recebido em fluxo. Devolve os itens e a posição onde parar.
+    """
+    if posicao == 0:
+        inicio = texto.find("[")
+        if inicio < 0:
+            return [], 0
+        posicao = inicio + 1
+    itens = []
+    while True:
+        while posicao < len(texto) and texto[posicao] in " \t\r\n,":
+            posicao += 1
+        if posicao >= len(texto) or texto[posicao] != "{":
+            return itens, posicao
+        try:
+            item, posicao = _decodificador_json.raw_decode(texto, posicao)
+        except json.JSONDecodeError:
+            return itens, posicao  # Item ainda incompleto: aguarda mais tokens.
+        itens.append(item)
+
+
+def _consultar_llm(lista_de_exames, ao_receber_item=None):
+    """
+    Envia os exames à Azure OpenAI e devolve (mnemonicos, linhas_avulsas):
+    `mnemonicos` tem um mnemônico por exame, na ordem recebida (None para os que
+    não puderam ser identificados na resposta), e `linhas_avulsas` traz, como
+    "Exame: Mnemônico", os itens da resposta que não correspondem a nenhum exame.
+    A resposta chega em fluxo (stream=True): cada item completo é repassado a
+    `ao_receber_item` assim que termina de chegar.
     """
     exames_para_processar = "\n".join(f"- {exame}" for exame in lista_de_exames)
     user_prompt = f"Por favor, forneça os mnemônicos para a seguinte lista de exames:\n{exames_para_processar}"
 
-    try:
-        client = AzureOpenAI(api_version=openai_api_version, azure_endpoint=openai_endpoint, api_key=openai_key)
-        response = client.chat.completions.create(
-            model=openai_deployment,
-            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-            temperature=0.1,
-            max_tokens=500
+    fluxo = OPENAI_CLIENT.chat.completions.create(
+        model=openai_deployment,
+        messages=[{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
+        temperature=0.1,
+        max_tokens=TOKENS_BASE_NLP + TOKENS_POR_EXAME_NLP * len(lista_de_exames),
+        response_format=FORMATO_RESPOSTA_NLP,
+        stream=True,
+        **({"stream_options": {"include_usage": True}} if USO_NO_FLUXO_DISPONIVEL else {})
+    )
+    texto, posicao, itens, motivo_fim = "", 0, [], None
+    for chunk in fluxo:
+        # Último chunk do fluxo quando include_usage foi pedido: serve para conferir
+        # se o cache de prefixo do SYSTEM_PROMPT está sendo aproveitado.
+        if getattr(chunk, "usage", None) is not None:
+            detalhes_prompt = getattr(chunk.usage, "prompt_tokens_details", None)
+            if detalhes_prompt is not None and detalhes_prompt.cached_tokens is not None:
+                print(f"Tokens do prompt: {chunk.usage.prompt_tokens} ({detalhes_prompt.cached_tokens} vindos do cache de prefixo).")
+        if chunk.choices and chunk.choices[0].finish_reason:
+            motivo_fim = chunk.choices[0].finish_reason
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        texto += chunk.choices[0].delta.content
+        novos_itens, posicao = _itens_completos(texto, posicao)
+        for item in novos_itens:
+            itens.append(item)
+            if ao_receber_item is not None:
+                ao_receber_item(item)
+
+    # Associa cada resposta ao exame pelo nome. Só as respostas confirmadas pelo
+    # nome vão para o cache; se o modelo alterou algum nome, a ordem é usada (o
+    # prompt pede a mesma ordem da lista recebida), mas nada é guardado.
+    mnemonicos_por_exame = {_chave_exame(item["exam"]): item["mnemonic"] for item in itens}
+    for exame in lista_de_exames:
+        if _chave_exame(exame) in mnemonicos_por_exame:
+            _guardar_mnemonico(exame, mnemonicos_por_exame[_chave_exame(exame)])
+
+    # Resposta cortada pelo limite de tokens: os exames que ficaram de fora não são
+    # descartados em silêncio; a falha é reportada a quem pediu.
+    if motivo_fim == "length":
+        raise RuntimeError(
+            f"Resposta da IA truncada pelo limite de tokens: {len(itens)} de {len(lista_de_exames)} exames respondidos."
         )
-        resultado_nlp = response.choices[0].message.content
-        print("✅ NLP concluído. Resposta recebida.")
-        return resultado_nlp
+    if all(_chave_exame(exame) in mnemonicos_por_exame for exame in lista_de_exames):
+        return [mnemonicos_por_exame[_chave_exame(exame)] for exame in lista_de_exames], []
+    if len(itens) == len(lista_de_exames):
+        return [item["mnemonic"] for item in itens], []
+    chaves_pedidas = {_chave_exame(exame) for exame in lista_de_exames}
+    return (
+        [mnemonicos_por_exame.get(_chave_exame(exame)) for exame in lista_de_exames],
+        [f"{item['exam']}: {item['mnemonic']}" for item in itens if _chave_exame(item["exam"]) not in chaves_pedidas]
+    )
+
+
+# --- Agrupamento de consultas NLP (coalescência entre requisições) ---
+# Requisições simultâneas enfileiram seus exames ainda não conhecidos; uma thread
+# coleta o que chegar numa janela curta e entrega o lote a um pool de threads,
+# que faz uma única chamada à IA para todos os exames do lote. Assim a latência
+# fixa de cada chamada é diluída sem impedir que vários lotes rodem em paralelo.
+# Exames repetidos no lote são consultados uma só vez.
+JANELA_LOTE_NLP = 0.05  # segundos
+MAX_EXAMES_POR_LOTE_NLP = 32
+MAX_LOTES_NLP_SIMULTANEOS = 8
+TIMEOUT_NLP = 120  # segundos que uma requisição espera pelos seus exames
+_fila_nlp = queue.Queue()
+_executor_lotes_nlp = ThreadPoolExecutor(max_workers=MAX_LOTES_NLP_SIMULTANEOS, thread_name_prefix="lote-nlp")
+_coletor_nlp = None
+_trava_coletor_nlp = threading.Lock()
+# Resultado de um exame cujo item na resposta não pôde ser identificado, mas que
+# já foi entregue à requisição entre as suas linhas avulsas (não há o que refazer).
+_ENTREGUE_EM_LINHAS_AVULSAS = object()
+
+
+def _consultar_lote_nlp(lote):
+    pendentes, requisicoes = {}, {}
+    for exame, futuro, linhas_avulsas_da_requisicao in lote:
+        pendentes.setdefault(_chave_exame(exame), (exame, []))[1].append(futuro)
+        requisicoes[id(linhas_avulsas_da_requisicao)] = linhas_avulsas_da_requisicao
+    exames = [exame for exame, _ in pendentes.values()]
+    print(f"Lote NLP: {len(exames)} exames distintos de {len(lote)} pedidos.")
+
+    # Os futuros recebem só o mnemônico: cada requisição monta a linha com o nome
+    # do exame como ela mesma o enviou.
+    def resolver(futuros, mnemonico):
+        for futuro in futuros:
+            if not futuro.done():
+                futuro.set_result(mnemonico)
+
+    # Os exames reconhecidos pelo nome são entregues enquanto a resposta ainda
+    # está chegando, sem esperar o fim do lote.
+    def ao_receber_item(item):
+        pendente = pendentes.get(_chave_exame(item["exam"]))
+        if pendente is not None:
+            resolver(pendente[1], item["mnemonic"])
+
+    try:
+        mnemonicos, linhas_avulsas = _consultar_llm(exames, ao_receber_item)
+    except Exception as e:
+        for _, futuros in pendentes.values():
+            for futuro in futuros:
+                if not futuro.done():
+                    futuro.set_exception(e)
+        return
+
+    # Exames que não puderam ser identificados na resposta: se o lote era de uma
+    # só requisição, a resposta já é a dela e os itens avulsos lhe são entregues
+    # (refazer a consulta repetiria o mesmo prompt). Se o lote misturava várias
+    # requisições, cada uma recebe None e refaz a consulta só com os seus exames.
+    sem_identificacao = None
+    if None in mnemonicos and len(requisicoes) == 1:
+        next(iter(requisicoes.values())).extend(linhas_avulsas)
+        sem_identificacao = _ENTREGUE_EM_LINHAS_AVULSAS
+    for (_, futuros), mnemonico in zip(pendentes.values(), mnemonicos):
+        resolver(futuros, mnemonico if mnemonico is not None else sem_identificacao)
+
+
+def _coletar_lotes_nlp():
+    while True:
+        lote = [_fila_nlp.get()]
+        prazo = time.monotonic() + JANELA_LOTE_NLP
+        while len(lote) < MAX_EXAMES_POR_LOTE_NLP:
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(_fila_nlp.get(timeout=restante))
+            except queue.Empty:
+                break
+        _executor_lotes_nlp.submit(_consultar_lote_nlp, lote)
+
+
+def _enviar_para_lote_nlp(exame, linhas_avulsas_da_requisicao):
+    global _coletor_nlp
+    with _trava_coletor_nlp:
+        if _coletor_nlp is None or not _coletor_nlp.is_alive():
+            _coletor_nlp = threading.Thread(target=_coletar_lotes_nlp, name="coletor-nlp", daemon=True)
+            _coletor_nlp.start()
+    futuro = Future()
+    _fila_nlp.put((exame, futuro, linhas_avulsas_da_requisicao))
+    return futuro
+
+
+def gerar_mnemonicos_com_nlp(lista_de_exames):
+    """
+    Função do NLP: Recebe uma lista de exames e usa a IA para encontrar
+    os mnemônicos correspondentes para cada um. Produz pares (exame, linha)
+    à medida que cada exame é resolvido: primeiro os da base local ou do cache,
+    depois os respondidos pela IA. Linhas que não puderam ser associadas a um
+    exame saem com exame None.
+    """
+    print("--- ETAPA 2: INICIANDO NLP PARA OBTER MNEMÔNICOS ---")
+    # Um exame marcado mais de uma vez sai uma vez para cada ocorrência.
+    ocorrencias = Counter(lista_de_exames)
+    resultados = {exame: _mnemonico_local(exame) or _mnemonico_em_cache(exame) for exame in ocorrencias}
+    exames_faltantes = [exame for exame, linha in resultados.items() if linha is None]
+    print(f"Base local/cache de mnemônicos: {len(resultados) - len(exames_faltantes)} de {len(resultados)} exames já conhecidos.")
+    for exame in lista_de_exames:
+        if resultados[exame] is not None:
+            yield exame, resultados[exame]
+    if not exames_faltantes:
+        return
+
+    sem_resposta, linhas_avulsas = set(), []
+    try:
+        futuros = {_enviar_para_lote_nlp(exame, linhas_avulsas): exame for exame in exames_faltantes}
+        try:
+            for futuro in as_completed(futuros, timeout=TIMEOUT_NLP):
+                exame, mnemonico = futuros[futuro], futuro.result()
+                if mnemonico is None:
+                    sem_resposta.add(exame)
+                elif mnemonico is not _ENTREGUE_EM_LINHAS_AVULSAS:
+                    for _ in range(ocorrencias[exame]):
+                        yield exame, f"{exame}: {mnemonico}"
+        except TempoEsgotadoFuturo:
+            raise TimeoutError(f"A IA não respondeu aos mnemônicos em {TIMEOUT_NLP} segundos.") from None
+
+        exames_sem_resposta = [exame for exame in exames_faltantes if exame in sem_resposta]
+        if exames_sem_resposta:
+            mnemonicos, linhas_da_nova_consulta = _consultar_llm(exames_sem_resposta)
+            linhas_avulsas.extend(linhas_da_nova_consulta)
     except Exception as e:
         print(f"❌ FALHA NO PROCESSAMENTO NLP: {e}")
         raise # Lança a exceção para ser tratada pela API
 
+    if exames_sem_resposta:
+        for exame, mnemonico in zip(exames_sem_resposta, mnemonicos):
+            if mnemonico is not None:
+                for _ in range(ocorrencias[exame]):
+                    yield exame, f"{exame}: {mnemonico}"
+    if linhas_avulsas:
+        # Itens que não correspondem a nenhum exame pedido são devolvidos como vieram.
+        print(f"AVISO: NLP retornou {len(linhas_avulsas)} itens que não correspondem aos exames pedidos.")
+        for linha in linhas_avulsas:
+            yield None, linha
+    print("✅ NLP concluído. Resposta recebida.")
+
+
+def obter_mnemonicos_com_nlp(lista_de_exames):
+    """
+    Versão completa de gerar_mnemonicos_com_nlp: devolve todas as linhas na
+    ordem da lista de exames recebida.
+    """
+    resultados, linhas_sem_exame = {}, []
+    for exame, linha in gerar_mnemonicos_com_nlp(lista_de_exames):
+        if exame is None:
+            linhas_sem_exame.append(linha)
+        else:
+            resultados[exame] = linha
+    return [resultados[exame] for exame in lista_de_exames if exame in resultados] + linhas_sem_exame
+
 # ==============================================================================
 # --- 4. DEFINIÇÃO DO ENDPOINT DA API ---
 # ==============================================================================
+def gerar_resposta_em_fluxo(attendant_id, pixeon_id, lista_de_exames):
+    """
+    Gera a resposta NDJSON do endpoint: uma linha por mnemônico, na ordem em que
+    ficam prontos, e uma linha final com o status (ou com o erro, já que o código
+    HTTP não pode mais ser alterado depois que o fluxo começou).
+    """
+    try:
+        for exame, linha in gerar_mnemonicos_com_nlp(lista_de_exames):
+            yield json.dumps({"attendant_id": attendant_id, "pixeon_id": pixeon_id, "exame": exame, "resultado_mnemonico": linha}) + "\n"
+        yield json.dumps({"attendant_id": attendant_id, "pixeon_id": pixeon_id, "status": "Sucesso"}) + "\n"
+    except Exception as e:
+        yield json.dumps({
+            "attendant_id": attendant_id,
+            "pixeon_id": pixeon_id,
+            "error": f"Ocorreu um erro interno durante o processamento de IA. Detalhes: {str(e)}"
+        }) + "\n"
+
+
 @app.route('/processar_documento', methods=['POST'])
 def processar_documento_endpoint():
     """
@@ -144,8 +690,19 @@ def processar_documento_endpoint():
     print("\n\n--- Nova requisição recebida no endpoint /processar_documento ---")
     
     # 1. Obter e validar o JSON da requisição
-    data = request.get_json()
-    if not data:
+    if request.content_length is not None and request.content_length > MAX_PAYLOAD_BYTES:
+        return jsonify({"error": f"Requisição muito grande. O limite é de {MAX_PAYLOAD_BYTES // (1024 * 1024)} MB."}), 413
+
+    # cache=False: o corpo bruto não fica guardado no objeto request depois do parse.
+    # Os dois caminhos leem o corpo do mesmo jeito (sem exigir Content-Type) e
+    # tratam JSON malformado ou bytes inválidos igualmente: ambos os erros
+    # herdam de ValueError.
+    try:
+        corpo = request.get_data(cache=False)
+        data = orjson.loads(corpo) if orjson is not None else json.loads(corpo)
+    except ValueError:
+        data = None
+    if not data or not isinstance(data, dict):
         return jsonify({"error": "Requisição inválida. Corpo deve ser um JSON."}), 400
 
     attendant_id = data.get('attendant_id')
@@ -156,29 +713,52 @@ def processar_documento_endpoint():
         return jsonify({"error": "Campos 'attendant_id', 'pixeon_id' e 'document' são obrigatórios."}), 400
 
     doc_type = document.get('type')
-    doc_content_b64 = document.get('content')
+    # O conteúdo é retirado do dicionário para que, após a decodificação, a string
+    # base64 possa ser liberada antes das chamadas de IA (que levam segundos).
+    doc_content_b64 = document.pop('content', None)
 
     if not all([doc_type, doc_content_b64]):
         return jsonify({"error": "Campos 'type' e 'content' dentro de 'document' são obrigatórios."}), 400
 
     # 2. Decodificar a imagem base64
+    # Cada 4 caracteres base64 viram 3 bytes: documentos grandes demais são
+    # recusados antes de gastar CPU e memória na decodificação.
+    if isinstance(doc_content_b64, str) and len(doc_content_b64) * 3 // 4 > MAX_DOCUMENTO_BYTES:
+        return jsonify({"error": f"Documento muito grande. O limite é de {MAX_DOCUMENTO_BYTES // (1024 * 1024)} MB."}), 413
+
+    # Os dois decodificadores leem a string ASCII diretamente, sem a cópia
+    # intermediária para bytes que base64.b64decode faz.
     try:
-        image_bytes = base64.b64decode(doc_content_b64)
+        image_bytes = decodificar_base64(doc_content_b64)
         content_type = f"image/{doc_type}" if doc_type != "pdf" else "application/pdf"
-    except (base64.binascii.Error, TypeError) as e:
+    except (binascii.Error, TypeError, ValueError) as e:
         return jsonify({"error": f"String base64 inválida. Detalhes: {e}"}), 400
+    del doc_content_b64
 
     # 3. Executar o pipeline de IA (OCR -> NLP)
     try:
         lista_de_exames = extrair_exames_do_documento(image_bytes, content_type)
-        
+
+        # Com "Accept: application/x-ndjson", cada mnemônico é enviado numa linha
+        # própria assim que fica pronto, sem esperar pelos demais exames.
+        resposta_em_fluxo = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
         if not lista_de_exames:
-            return jsonify({
+            resposta_vazia = {
                 "attendant_id": attendant_id,
                 "pixeon_id": pixeon_id,
                 "status": "Concluído",
                 "message": "Nenhum exame selecionado foi encontrado no documento."
-            }), 200
+            }
+            if resposta_em_fluxo:
+                return Response(json.dumps(resposta_vazia) + "\n", content_type="application/x-ndjson"), 200
+            return jsonify(resposta_vazia), 200
+
+        if resposta_em_fluxo:
+            return Response(
+                stream_with_context(gerar_resposta_em_fluxo(attendant_id, pixeon_id, lista_de_exames)),
+                content_type="application/x-ndjson"
+            )
 
         resultado_final = obter_mnemonicos_com_nlp(lista_de_exames)
 
@@ -187,7 +767,7 @@ def processar_documento_endpoint():
             "attendant_id": attendant_id,
             "pixeon_id": pixeon_id,
             "status": "Sucesso",
-            "resultado_mnemonicos": resultado_final.strip().split('\n')
+            "resultado_mnemonicos": resultado_final
         }), 200
 
     except Exception as e:
@@ -197,11 +777,25 @@ def processar_documento_endpoint():
 # ==============================================================================
 # --- 5. INICIAR O SERVIDOR DA API ---
 # ==============================================================================
+# Em produção, rode com Gunicorn e workers gevent: OCR e NLP são chamadas de rede,
+# então cada worker mantém centenas de requisições em andamento ao mesmo tempo:
+#
+#   gunicorn -k gevent -w 4 --worker-connections 200 --timeout 120 app:app
+#
+# O worker gevent aplica o monkey-patch (sockets, threads, filas) antes de
+# carregar o app, então os clientes, caches e o lote de NLP funcionam sem mudanças.
+# O gunicorn.conf.py deste diretório é lido automaticamente e aquece as conexões
+# de cada worker depois que ele sobe.
 if __name__ == '__main__':
     # Validação inicial das credenciais antes de iniciar o servidor
     if any(val == "???" for val in [doc_intel_endpoint, doc_intel_key, openai_endpoint, openai_key, openai_api_version]):
         print("\n❌ ERRO FATAL: Preencha TODAS as variáveis de credenciais no topo do código antes de iniciar a API.")
     else:
-        # app.run() é para desenvolvimento. Em produção, usa-se um servidor WSGI como Gunicorn.
+        # app.run() é só para desenvolvimento (debug apenas com FLASK_DEBUG=1).
+        modo_debug = os.environ.get("FLASK_DEBUG") == "1"
+        # Com debug, o reloader executa este bloco também no processo pai, que só
+        # vigia os arquivos; o aquecimento fica apenas no processo que atende.
+        if not modo_debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            iniciar_aquecimento()
         print("🚀 Servidor Flask iniciado. Aguardando requisições em http://127.0.0.1:5000/processar_documento" )
-        app.run(debug=True, port=5000)
+        app.run(debug=modo_debug, port=5000, threaded=True)
@@ -0,0 +1,11 @@
+# ==============================================================================
+# --- CONFIGURAÇÃO DO GUNICORN ---
+# ==============================================================================
+# Lido automaticamente pelo Gunicorn quando iniciado a partir deste diretório.
+
+
+def post_worker_init(worker):
+    # Roda em cada worker depois que o app foi carregado (inclusive com --preload),
+    # para que o pool de conexões de cada processo já comece aquecido.
+    from app import iniciar_aquecimento
+    iniciar_aquecimento()